@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+Offline benchmark for the face pipeline.
+
+Runs a fixed corpus of photos through the app's own load_bgr and detect_faces,
+plus the scoring step of a match, and reports per-stage latency
+percentiles, throughput and peak memory as JSON. With --compare it checks the
+result against a saved baseline and exits 1 if anything got slower beyond the
+tolerance, or if a different number of faces was found.
+
+The corpus is synthesised once from a few photos of people (--seed-photos) into
+group shots of fixed sizes and face counts, or copied from a folder of real
+photos (--from), and kept in output/benchmark. Nothing is downloaded: the model
+weights must already be in torch's cache, as they are after the app's first run.
+
+    python benchmark.py --seed-photos ~/faces --save-baseline baseline.json
+    python benchmark.py --compare baseline.json
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import app
+
+BENCH_DIR = os.path.join(app.app.config['OUTPUT_FOLDER'], 'benchmark')
+CORPUS_SEED = 20260818
+# name, width, height, faces, face size as a fraction of the short side
+CORPUS_CLASSES = (
+    ('portrait', 1080, 1350, 1, 0.45),
+    ('phone', 3024, 4032, 1, 0.30),
+    ('pair', 1920, 1080, 2, 0.30),
+    ('group', 4000, 3000, 8, 0.12),
+    ('team', 6000, 4000, 24, 0.06),
+    ('crowd', 6000, 4000, 60, 0.03),
+    ('venue', 1920, 1280, 0, 0.0),
+)
+SCORE_ROWS = 100000
+TOLERANCE = 0.10
+
+
+class Recorder(app.Metrics):
+    """Keeps every stage timing, not just histogram buckets, so percentiles are exact."""
+
+    def __init__(self):
+        super().__init__()
+        self.samples = {}
+
+    def observe(self, name, seconds, **labels):
+        if name == 'tiam_stage_seconds':
+            self.samples.setdefault(labels['stage'], []).append(seconds)
+
+    def flush(self):
+        pass
+
+
+def seed_faces(folder):
+    """Square face crops, with margin, from every photo of people in folder."""
+    crops = []
+    for name in sorted(os.listdir(folder)):
+        if os.path.splitext(name)[1].lower() not in app.VALID_EXT:
+            continue
+        img = cv2.imread(os.path.join(folder, name), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        img = app.resize_max(img)
+        boxes, probs = app.face_detector.detect(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        if boxes is None:
+            continue
+        h, w = img.shape[:2]
+        for (x1, y1, x2, y2), prob in zip(boxes, probs):
+            if prob < 0.95:
+                continue
+            cx, cy, side = (x1 + x2) / 2, (y1 + y2) / 2, max(x2 - x1, y2 - y1) * 1.6
+            sx1, sy1 = int(max(0, cx - side / 2)), int(max(0, cy - side / 2))
+            sx2, sy2 = int(min(w, cx + side / 2)), int(min(h, cy + side / 2))
+            if min(sx2 - sx1, sy2 - sy1) >= 64:
+                crops.append(img[sy1:sy2, sx1:sx2])
+    return crops
+
+
+def compose(rng, crops, width, height, faces, frac):
+    """One synthetic photo: a textured background with faces laid out in rows, those at
+    the back smaller, like a team photo."""
+    ramp = np.linspace(60, 190, width, dtype=np.float32)[None, :, None]
+    img = np.broadcast_to(ramp, (height, width, 3)) + rng.normal(0, 12, (height, width, 3))
+    img = np.clip(img * rng.uniform(0.7, 1.0, 3), 0, 255).astype(np.uint8)
+    if not faces:
+        return img
+    rows = max(1, round(math.sqrt(faces * height / width)))
+    cols = math.ceil(faces / rows)
+    cell_w, cell_h = width / cols, height / rows
+    base = frac * min(width, height)
+    for i in range(faces):
+        row, col = divmod(i, cols)
+        depth = 0.6 + 0.4 * row / max(1, rows - 1)
+        side = int(min(base * depth * rng.uniform(0.85, 1.15), cell_w * 0.9, cell_h * 0.9))
+        x = int(col * cell_w + rng.uniform(0, cell_w - side))
+        y = int(row * cell_h + rng.uniform(0, cell_h - side))
+        crop = crops[rng.integers(len(crops))]
+        img[y:y + side, x:x + side] = cv2.resize(crop, (side, side), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def build_corpus(name, seed_photos=None, source=None, per_class=3):
+    """Create output/benchmark/<name> once and return its manifest."""
+    folder = os.path.join(BENCH_DIR, name)
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    if not seed_photos and not source:
+        sys.exit(f'No corpus at {folder}. Pass --seed-photos DIR (a few photos of people) '
+                 f'to synthesise one, or --from DIR to copy real photos in.')
+
+    os.makedirs(folder, exist_ok=True)
+    photos = []
+    if source:
+        for entry in sorted(os.listdir(source)):
+            if os.path.splitext(entry)[1].lower() in app.VALID_EXT:
+                shutil.copyfile(os.path.join(source, entry), os.path.join(folder, entry))
+                photos.append({'file': entry, 'class': 'real', 'faces': None})
+    else:
+        crops = seed_faces(seed_photos)
+        if not crops:
+            sys.exit(f'No clear faces found in {seed_photos}')
+        rng = np.random.default_rng(CORPUS_SEED)
+        for cls, width, height, faces, frac in CORPUS_CLASSES:
+            for i in range(per_class):
+                entry = f'{cls}_{i}.jpg'
+                img = compose(rng, crops, width, height, faces, frac)
+                cv2.imwrite(os.path.join(folder, entry), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+                photos.append({'file': entry, 'class': cls, 'faces': faces})
+
+    digest = hashlib.sha256()
+    for photo in photos:
+        with open(os.path.join(folder, photo['file']), 'rb') as f:
+            digest.update(f.read())
+    manifest = {'name': name, 'photos': photos, 'digest': digest.hexdigest()}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def summary(seconds):
+    a = np.asarray(seconds)
+    return {
+        'count': len(a),
+        'total': round(float(a.sum()), 4),
+        'mean': round(float(a.mean()), 5),
+        'p50': round(float(np.percentile(a, 50)), 5),
+        'p90': round(float(np.percentile(a, 90)), 5),
+        'p99': round(float(np.percentile(a, 99)), 5),
+    }
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return app.rss_bytes()
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb if sys.platform == 'darwin' else kb * 1024
+
+
+def environment(threads):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'torch': app.torch.__version__,
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'device': str(app.device),
+        'cpus': os.cpu_count(),
+        'threads': threads,
+        'tiled': app.TILED_DETECTION,
+        'prefilter': app.NO_FACE_PREFILTER,
+        'machine': platform.machine(),
+    }
+
+
+def run(manifest, repeat, threads):
+    """Time every photo repeat times, after one untimed pass to warm the models up."""
+    folder = os.path.join(BENCH_DIR, manifest['name'])
+    paths = [os.path.join(folder, p['file']) for p in manifest['photos']]
+    app.apply_cpu_share(threads)
+    recorder = app.metrics = Recorder()
+
+    rejected = set()
+
+    def pipeline(path):
+        img = app.load_bgr(path)
+        if app.NO_FACE_PREFILTER and not app.might_have_faces(img):
+            rejected.add(os.path.basename(path))
+            return []
+        return app.detect_faces(img)[1]
+
+    for path in paths:
+        pipeline(path)
+    recorder.samples.clear()
+
+    photo_seconds, by_class, found = [], {}, {}
+    rng = np.random.default_rng(CORPUS_SEED)
+    ref = rng.normal(size=app.EMBEDDING_DIM).astype(np.float32)
+    ref /= np.linalg.norm(ref)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for photo, path in zip(manifest['photos'], paths):
+            t = time.perf_counter()
+            faces = pipeline(path)
+            if faces:
+                # the match loop's scoring step, on this photo's faces
+                with app.stage('score'):
+                    emb = np.stack([f['embedding'] for f in faces]).astype(app.EMBEDDING_DTYPE)
+                    max((emb.astype(np.float32) @ ref).tolist())
+            elapsed = time.perf_counter() - t
+            photo_seconds.append(elapsed)
+            by_class.setdefault(photo['class'], []).append(elapsed)
+            found[photo['file']] = len(faces)
+    wall = time.perf_counter() - started
+
+    # scoring a whole stored matrix, as a re-match against thousands of photos does
+    matrix = rng.normal(size=(SCORE_ROWS, app.EMBEDDING_DIM)).astype(app.EMBEDDING_DTYPE)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        matrix.astype(np.float32) @ ref
+    score_rows_per_sec = SCORE_ROWS * repeat / (time.perf_counter() - t)
+
+    faces_total = sum(found.values()) * repeat
+    expected = [p['faces'] for p in manifest['photos']]
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(threads),
+        'corpus': {'name': manifest['name'], 'digest': manifest['digest'], 'photos': len(paths),
+                   'faces_placed': sum(expected) if None not in expected else None},
+        'repeat': repeat,
+        'stages': {name: summary(s) for name, s in sorted(recorder.samples.items())},
+        'photo': summary(photo_seconds),
+        'classes': {cls: summary(s) for cls, s in by_class.items()},
+        'throughput': {
+            'images_per_sec': round(len(photo_seconds) / wall, 3),
+            'faces_per_sec': round(faces_total / wall, 3),
+            'score_rows_per_sec': round(score_rows_per_sec),
+        },
+        'faces_found': found,
+        'prefiltered': sorted(rejected),
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of result against baseline, as readable lines."""
+    problems = []
+    if result['corpus']['digest'] != baseline['corpus']['digest']:
+        problems.append('corpus differs from the baseline\'s; the numbers are not comparable')
+    for key in ('cpus', 'threads', 'device', 'tiled', 'prefilter'):
+        if result['environment'][key] != baseline['environment'].get(key):
+            print(f"note: {key} was {baseline['environment'].get(key)}, now {result['environment'][key]}")
+
+    latencies = [('photo', result['photo'], baseline['photo'])]
+    latencies += [(f'stage {name}', s, baseline['stages'][name])
+                  for name, s in result['stages'].items() if name in baseline['stages']]
+    latencies += [(f'class {cls}', s, baseline['classes'][cls])
+                  for cls, s in result['classes'].items() if cls in baseline['classes']]
+    for label, now, before in latencies:
+        for pct in ('p50', 'p90'):
+            if before[pct] > 0 and now[pct] > before[pct] * (1 + tolerance):
+                problems.append(f'{label} {pct} {before[pct] * 1000:.1f} ms -> {now[pct] * 1000:.1f} ms '
+                                f'(+{(now[pct] / before[pct] - 1) * 100:.0f}%)')
+    for key, now in result['throughput'].items():
+        before = baseline['throughput'].get(key)
+        if before and now < before * (1 - tolerance):
+            problems.append(f'{key} {before} -> {now} ({(now / before - 1) * 100:.0f}%)')
+    before = baseline['peak_rss_bytes']
+    if result['peak_rss_bytes'] > before * (1 + tolerance):
+        problems.append(f"peak RSS {before / 1e6:.0f} MB -> {result['peak_rss_bytes'] / 1e6:.0f} MB")
+    changed = [f for f, n in result['faces_found'].items() if baseline['faces_found'].get(f, n) != n]
+    if changed:
+        problems.append(f'faces found changed in {len(changed)} photos ({", ".join(changed[:5])}); '
+                        f'run calibrate.py before trusting the speed-up')
+    return problems
+
+
+def report(result):
+    print(f"{result['corpus']['photos']} photos x {result['repeat']}, {result['environment']['threads']} threads")
+    print(f"{'':12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'count':>8}")
+    rows = [(name, s) for name, s in result['stages'].items()] + [('photo', result['photo'])]
+    rows += [(cls, s) for cls, s in result['classes'].items()]
+    for name, s in rows:
+        print(f"{name:12}{s['p50'] * 1000:10.1f}{s['p90'] * 1000:10.1f}{s['p99'] * 1000:10.1f}{s['count']:8}")
+    t = result['throughput']
+    print(f"{t['images_per_sec']} images/s, {t['faces_per_sec']} faces/s, "
+          f"{t['score_rows_per_sec']:,} rows/s scored, peak RSS {result['peak_rss_bytes'] / 1e6:.0f} MB")
+    placed = result['corpus']['faces_placed']
+    if placed is not None:
+        print(f"faces found {sum(result['faces_found'].values())} of {placed} placed")
+    if result['prefiltered']:
+        print(f"prefilter skipped {len(result['prefiltered'])} photos: {', '.join(result['prefiltered'][:10])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the face pipeline on a fixed local corpus.')
+    parser.add_argument('--corpus', default='default', help='corpus name under output/benchmark')
+    parser.add_argument('--seed-photos', help='photos of people to synthesise the corpus from, first run only')
+    parser.add_argument('--from', dest='source', help='folder of real photos to use as the corpus, first run only')
+    parser.add_argument('--per-class', type=int, default=3, help='synthetic photos per size class')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=app.CPU_BUDGET, help='torch and OpenCV threads')
+    parser.add_argument('--tiled', action='store_true', help='turn on tiled detection for big group photos')
+    parser.add_argument('--prefilter', action='store_true', help='turn on the no-face prefilter')
+    parser.add_argument('--out', help='where to write the result JSON (default output/benchmark/<corpus>-<time>.json)')
+    parser.add_argument('--save-baseline', help='also write the result here, to --compare against later')
+    parser.add_argument('--compare', help='baseline JSON to check this run against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slow-down, as a fraction')
+    args = parser.parse_args()
+
+    if app.face_detector is None:
+        sys.exit(f'Face models did not load: {app.model_error}. The weights must be cached; '
+                 f'run the app once with network access.')
+    app.TILED_DETECTION = app.TILED_DETECTION or args.tiled
+    app.NO_FACE_PREFILTER = app.NO_FACE_PREFILTER or args.prefilter
+    manifest = build_corpus(args.corpus, args.seed_photos, args.source, args.per_class)
+    result = run(manifest, args.repeat, args.threads)
+    report(result)
+
+    out = args.out or os.path.join(BENCH_DIR, f"{args.corpus}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    for path in filter(None, (out, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=1)
+        print(f'wrote {path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        problems = compare(result, baseline, args.tolerance)
+        for line in problems:
+            print(f'REGRESSION: {line}')
+        if problems:
+            sys.exit(1)
+        print(f'no regressions against {args.compare} (tolerance {args.tolerance:.0%})')
+
+
+if __name__ == '__main__':
+    main()
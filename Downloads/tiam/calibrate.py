@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+Calibration and parity check for the face pipeline.
+
+SIM_THRESHOLD is only valid for the exact pipeline it was measured on. This runs a
+labelled set of same-person and different-person photo pairs through the reference
+pipeline and through a candidate configuration (a faster path, say). It reports both
+score distributions, the false accept and false reject rates at the threshold, and
+how far each photo's embedding moved. If the candidate moves any of them beyond
+tolerance it prints FAIL and exits 1, so a speed-up that changes who matches whom
+cannot be switched on by accident.
+
+Pairs come either from a CSV of path_a,path_b,same (1 or 0, paths relative to the
+CSV), or from a folder with one sub-folder of photos per person, from which --count
+same and different pairs are drawn with a fixed seed.
+
+--config template checks enrolled people instead of a faster path. From --people it
+enrols --enrol photos of each person as the app does, scores --count held-out photos
+of the same people and --count of others against those templates, and fails if
+templates let in more strangers at PERSON_THRESHOLD than single photos do at
+SIM_THRESHOLD. Pass --threshold to try another value for PERSON_THRESHOLD.
+
+    python calibrate.py --people ~/lfw --config stored
+    python calibrate.py --pairs pairs.csv --config stored --out calibration.json
+    python calibrate.py --people ~/lfw --config template --enrol 3
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+import app
+
+# A configuration is a set of keyword arguments to embed(). 'reference' is what the
+# threshold was calibrated on; the others are candidates to check against it.
+CONFIGS = {
+    'reference': {},
+    # as the embeddings matrix stores them
+    'stored': {'float16': True},
+    'max_dim_960': {'max_dim': 960},
+    'tiled': {'tiled': True},
+    # photos the no-face prefilter rejects count as no face found, which fails the check
+    'prefilter': {'prefilter': True},
+    # enrolled people's templates against held-out photos; see template_probes
+    'template': {},
+}
+PAIR_SEED = 20260818
+PERCENTILES = (('same', 5), ('same', 10), ('same', 50), ('different', 95), ('different', 99), ('different', 100))
+# Beyond these the candidate fails
+TOL_PERCENTILE = 0.01      # any reported percentile, in cosine similarity
+TOL_RATE = 0.005           # FAR or FRR, as a fraction of pairs
+TOL_DRIFT = 0.02           # largest cosine distance between a photo's two embeddings
+TOL_FLIPS = 0.005          # pairs decided the other way at the threshold, as a fraction
+TOL_NO_FACE = 0            # extra photos in which no face was found
+
+
+def embed(path, max_dim=1280, float16=False, tiled=False, prefilter=False):
+    """The embedding of the most confident face in a photo, through the app's pipeline;
+    None if no face is found."""
+    img = app.load_bgr(path)
+    if img is None:
+        return None
+    if prefilter and app.face_likelihood(img) < app.PREFILTER_THRESHOLD:
+        return None
+    _, faces = app.detect_faces(img, max_dim, tiled)
+    if not faces:
+        return None
+    best = max(faces, key=lambda f: (f['score'], (f['bbox'][2] - f['bbox'][0]) * (f['bbox'][3] - f['bbox'][1])))
+    v = best['embedding'].astype(np.float32)
+    if float16:
+        v = v.astype(app.EMBEDDING_DTYPE).astype(np.float32)
+    return v
+
+
+def csv_pairs(path):
+    base = os.path.dirname(os.path.abspath(path))
+    pairs = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or row[2].strip() not in ('0', '1'):
+                continue  # header or blank
+            a, b = (os.path.join(base, p.strip()) for p in row[:2])
+            pairs.append((a, b, row[2].strip() == '1'))
+    return pairs
+
+
+def people_photos(folder):
+    """{person: sorted photo paths} for each sub-folder of folder with any photos."""
+    people = {}
+    for name in sorted(os.listdir(folder)):
+        d = os.path.join(folder, name)
+        if os.path.isdir(d):
+            photos = sorted(os.path.join(d, p) for p in os.listdir(d)
+                            if os.path.splitext(p)[1].lower() in app.VALID_EXT)
+            if photos:
+                people[name] = photos
+    return people
+
+
+def people_pairs(folder, count):
+    """count same-person and count different-person pairs, the same every run."""
+    people = people_photos(folder)
+    rng = random.Random(PAIR_SEED)
+    several = [p for p in people if len(people[p]) >= 2]
+    if not several or len(people) < 2:
+        sys.exit(f'{folder} needs at least two people, one of them with two or more photos')
+    same, different = set(), set()
+    for _ in range(count * 20):
+        if len(same) >= count:
+            break
+        same.add(tuple(rng.sample(people[rng.choice(several)], 2)))
+    names = sorted(people)
+    for _ in range(count * 20):
+        if len(different) >= count:
+            break
+        p, q = rng.sample(names, 2)
+        different.add((rng.choice(people[p]), rng.choice(people[q])))
+    return [(a, b, True) for a, b in sorted(same)] + [(a, b, False) for a, b in sorted(different)]
+
+
+def template_probes(folder, enrol, count):
+    """({person: photos to enrol}, [(person, held-out photo, same)]) with count probes of
+    each kind, the same every run. Only people with a photo left over after enrolling are
+    enrolled; different-person probes may be anyone else's photo, enrolled or not."""
+    people = people_photos(folder)
+    rng = random.Random(PAIR_SEED)
+    enrolled = {name: rng.sample(photos, enrol) for name, photos in people.items() if len(photos) > enrol}
+    if len(enrolled) < 2:
+        sys.exit(f'{folder} needs at least two people with more than {enrol} photos each')
+    same = [(name, p, True) for name in enrolled for p in people[name] if p not in enrolled[name]]
+    different = [(name, p, False) for name in enrolled for other in people if other != name
+                 for p in people[other] if p not in enrolled.get(other, ())]
+    rng.shuffle(same)
+    rng.shuffle(different)
+    return enrolled, sorted(same[:count]) + sorted(different[:count])
+
+
+def run_templates(enrolled, probes):
+    """The score of each probe against its person's template, built by the app's own
+    person_template from the embeddings of the enrolled photos with a face."""
+    paths = {p for photos in enrolled.values() for p in photos} | {p for _, p, _ in probes}
+    embeddings = {path: embed(path) for path in sorted(paths)}
+    templates = {}
+    for name, photos in enrolled.items():
+        members = [embeddings[p] for p in photos if embeddings[p] is not None]
+        if members:
+            members = np.stack([v / (np.linalg.norm(v) + 1e-9) for v in members])
+            templates[name] = app.person_template(members)
+    return [(float(templates[name] @ embeddings[p]) if name in templates and embeddings[p] is not None
+             else None) for name, p, _ in probes]
+
+
+def check_templates(ref, cand):
+    """Every way templates at their threshold let in more than single photos at theirs."""
+    problems = []
+    if cand['far'] - ref['far'] > TOL_RATE:
+        problems.append(f"false accepts rose {ref['far']:.2%} -> {cand['far']:.2%}")
+    # the closest stranger's distance below the line, which is what a hard pair tests
+    before, now = (r['threshold'] - r['percentiles']['different p100'] for r in (ref, cand))
+    if now < before - TOL_PERCENTILE:
+        problems.append(f'the closest stranger is {now:.4f} below PERSON_THRESHOLD, against {before:.4f} '
+                        f'below SIM_THRESHOLD for single photos')
+    return problems
+
+
+def passing_threshold(ref, different):
+    """The lowest threshold, in hundredths, at which templates would pass check_templates,
+    given every different-person template score."""
+    different = np.sort(np.asarray(different))
+    floor = different[-1] + ref['threshold'] - ref['percentiles']['different p100'] - TOL_PERCENTILE
+    for t in np.arange(np.ceil(floor * 100) / 100, 1.0, 0.01):
+        if (different >= t).mean() - ref['far'] <= TOL_RATE:
+            return round(float(t), 2)
+    return None
+
+
+def run(pairs, config):
+    """Embeddings for every photo in the pairs, and the score of each pair both sides of
+    which have a face."""
+    embeddings = {}
+    for path in sorted({p for a, b, _ in pairs for p in (a, b)}):
+        embeddings[path] = embed(path, **config)
+    scores = [(float(embeddings[a] @ embeddings[b]) if embeddings[a] is not None and embeddings[b] is not None
+               else None) for a, b, _ in pairs]
+    return embeddings, scores
+
+
+def measure(pairs, scores, threshold):
+    same = np.array([s for (_, _, is_same), s in zip(pairs, scores) if is_same and s is not None])
+    different = np.array([s for (_, _, is_same), s in zip(pairs, scores) if not is_same and s is not None])
+    if not len(same) or not len(different):
+        sys.exit('Too few pairs with a face on both sides to measure anything')
+    kinds = {'same': same, 'different': different}
+    return {
+        'pairs': {'same': len(same), 'different': len(different),
+                  'skipped': sum(s is None for s in scores)},
+        'percentiles': {f'{kind} p{pct}': round(float(np.percentile(kinds[kind], pct)), 4)
+                        for kind, pct in PERCENTILES},
+        'far': round(float((different >= threshold).mean()), 4),
+        'frr': round(float((same < threshold).mean()), 4),
+    }
+
+
+def drift(reference, candidate, ref_scores, scores, threshold):
+    """How far the candidate moved each photo's embedding, and how many pairs it decided
+    the other way."""
+    distances = [max(0.0, 1.0 - float(reference[p] @ candidate[p])) for p in reference
+                 if reference[p] is not None and candidate[p] is not None]
+    flips = sum((r >= threshold) != (c >= threshold) for r, c in zip(ref_scores, scores)
+                if r is not None and c is not None)
+    return {
+        'max': float(max(distances, default=0.0)),
+        'mean': float(np.mean(distances)) if distances else 0.0,
+        'flips': flips,
+        'no_face_reference': sum(v is None for v in reference.values()),
+        'no_face_candidate': sum(v is None for v in candidate.values()),
+    }
+
+
+def check(ref, cand, moved, total_pairs):
+    """Every way the candidate is out of tolerance, as readable lines."""
+    problems = []
+    for key, before in ref['percentiles'].items():
+        now = cand['percentiles'][key]
+        if abs(now - before) > TOL_PERCENTILE:
+            problems.append(f'{key} moved {before:.4f} -> {now:.4f}')
+    for key, label in (('far', 'false accepts'), ('frr', 'false rejects')):
+        if cand[key] - ref[key] > TOL_RATE:
+            problems.append(f'{label} rose {ref[key]:.2%} -> {cand[key]:.2%}')
+    if moved['max'] > TOL_DRIFT:
+        problems.append(f"an embedding drifted {moved['max']:.2e} (cosine distance)")
+    if moved['flips'] > TOL_FLIPS * total_pairs:
+        problems.append(f"{moved['flips']} pairs decided the other way at the threshold")
+    if moved['no_face_candidate'] - moved['no_face_reference'] > TOL_NO_FACE:
+        problems.append(f"no face found in {moved['no_face_candidate']} photos, "
+                        f"against {moved['no_face_reference']} for the reference")
+    return problems
+
+
+def report(name, result, threshold):
+    p = result['pairs']
+    print(f"{name}: {p['same']} same / {p['different']} different pairs ({p['skipped']} skipped, no face)")
+    print('  ' + '  '.join(f'{k}={v:.3f}' for k, v in result['percentiles'].items()))
+    print(f"  at {threshold:.2f}: false accepts {result['far']:.2%}, false rejects {result['frr']:.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a pipeline configuration against the calibrated one.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--pairs', help='CSV of path_a,path_b,same')
+    source.add_argument('--people', help='folder with a sub-folder of photos per person')
+    parser.add_argument('--count', type=int, default=300, help='pairs of each kind drawn from --people')
+    parser.add_argument('--config', default='reference', choices=sorted(CONFIGS))
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='default SIM_THRESHOLD, or PERSON_THRESHOLD for --config template')
+    parser.add_argument('--enrol', type=int, default=3, help='photos enrolled per person for --config template')
+    parser.add_argument('--out', help='write the full report here as JSON')
+    args = parser.parse_args()
+
+    if app.face_detector is None:
+        sys.exit(f'Face models did not load: {app.model_error}')
+    if args.config == 'template' and not args.people:
+        sys.exit('--config template enrols people, so it needs --people')
+    # for templates, --threshold is a candidate PERSON_THRESHOLD; single photos stay at SIM_THRESHOLD
+    threshold = app.SIM_THRESHOLD if args.threshold is None or args.config == 'template' else args.threshold
+    pairs = csv_pairs(args.pairs) if args.pairs else people_pairs(args.people, args.count)
+    # the pair set lives outside uploads/ and output/; let load_bgr read it, and every
+    # person's folder, which templates draw on beyond the pairs
+    photos = [p for a, b, _ in pairs for p in (a, b)]
+    if args.people:
+        photos += [p for people in people_photos(args.people).values() for p in people]
+    roots = {os.path.realpath(os.path.dirname(p)) for p in photos}
+    app.ALLOWED_ROOTS = app.ALLOWED_ROOTS + tuple(sorted(roots))
+
+    ref_embeddings, ref_scores = run(pairs, CONFIGS['reference'])
+    reference = measure(pairs, ref_scores, threshold)
+    report('reference', reference, threshold)
+    out = {'threshold': threshold, 'reference': reference}
+
+    problems = []
+    if args.config == 'template':
+        # single photos at SIM_THRESHOLD are the bar; templates are held to it at their own
+        person_threshold = app.PERSON_THRESHOLD if args.threshold is None else args.threshold
+        enrolled, probes = template_probes(args.people, args.enrol, args.count)
+        scores = run_templates(enrolled, probes)
+        candidate = measure(probes, scores, person_threshold)
+        report(f'template of {args.enrol}', candidate, person_threshold)
+        reference['threshold'], candidate['threshold'] = threshold, person_threshold
+        problems = check_templates(reference, candidate)
+        passing = passing_threshold(reference, [s for (_, _, same), s in zip(probes, scores)
+                                                if not same and s is not None])
+        print(f'  templates pass from PERSON_THRESHOLD = {passing}')
+        out.update(config=args.config, enrol=args.enrol, person_threshold=person_threshold,
+                   candidate=candidate, passing_threshold=passing, problems=problems)
+    elif args.config != 'reference':
+        embeddings, scores = run(pairs, CONFIGS[args.config])
+        candidate = measure(pairs, scores, threshold)
+        moved = drift(ref_embeddings, embeddings, ref_scores, scores, threshold)
+        report(args.config, candidate, threshold)
+        print(f"  embedding drift max {moved['max']:.2e}, mean {moved['mean']:.2e}; "
+              f"{moved['flips']} decisions flipped")
+        problems = check(reference, candidate, moved, len(pairs))
+        out.update(config=args.config, candidate=candidate, drift=moved, problems=problems)
+        if CONFIGS[args.config].get('prefilter'):
+            # how close the gate came to turning away a photo the detector finds a face in
+            lowest = min(app.face_likelihood(app.load_bgr(p)) for p, v in ref_embeddings.items() if v is not None)
+            print(f'  prefilter: lowest score on a photo with a face {lowest:.3f}, '
+                  f'threshold {app.PREFILTER_THRESHOLD:.2f}')
+            out['prefilter_lowest'] = lowest
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=1)
+    if problems:
+        print(f'\nFAIL: {args.config} is not a drop-in for the calibrated pipeline', file=sys.stderr)
+        for line in problems:
+            print(f'  - {line}', file=sys.stderr)
+        sys.exit(1)
+    if args.config != 'reference':
+        print(f'\nPASS: {args.config} keeps the calibration within tolerance')
+
+
+if __name__ == '__main__':
+    main()
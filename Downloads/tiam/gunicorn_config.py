@@ -6,13 +6,22 @@ import os
 bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
 backlog = 2048
 
-# Worker processes
-workers = 2
-worker_class = 'sync'
+# One worker process, with threads. Reference faces, jobs polled at /api/jobs/<id> and
+# the inference scheduler's queue all live in the process's memory; with a second
+# worker, half the polls and matches land on a process that has never heard of them.
+# Detection releases the GIL in torch and OpenCV, so threads lose nothing to processes.
+workers = 1
+worker_class = 'gthread'
+threads = 8
 worker_connections = 1000
 timeout = 120
 keepalive = 5
 
+# Load app.py, and with it the face models, once in the master before forking. The
+# worker shares the weights copy-on-write instead of loading its own copy, and a
+# restarted worker is serving as soon as it forks.
+preload_app = True
+
 # Logging
 accesslog = '-'
 errorlog = '-'
@@ -30,3 +39,30 @@ user = None
 group = None
 tmp_upload_dir = None
 
+
+def on_starting(server):
+    # The match queue, its positions and the one-match-per-visitor limit are kept in the
+    # process, as are reference faces and jobs. A second worker keeps a second set, and a
+    # visitor can run a match on each while both report the wrong place in the queue.
+    if server.cfg.workers != 1:
+        raise RuntimeError(f'run one worker, not {server.cfg.workers}: raise threads for more '
+                           f'concurrency')
+
+
+def when_ready(server):
+    # The master has loaded the app and is about to fork. Move everything it allocated
+    # out of the garbage collector's reach, so collections in the workers do not touch,
+    # and so copy, the pages they share with it.
+    import gc
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Warm the models up in each worker as it starts, not on its first visitor.
+    # /readyz answers 503 until this finishes. Each worker also runs the disk
+    # sweeper, which a file lock lets only one run at a time, and writes its metrics
+    # where /metrics in any worker can add them up.
+    import app
+    app.start_warmup()
+    app.start_sweeper()
+    app.metrics.start()
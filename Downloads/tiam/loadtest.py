@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+Load test: many visitors at once against a local server.
+
+Starts gunicorn with gunicorn_config.py in a scratch folder, so no real visitor's
+files are touched, with Google Drive replaced by a local folder of photos. Then, for
+each concurrency level, that many scripted visitors at once each upload photos,
+import a Drive folder, page the gallery, open a photo, set a face, run a match,
+page the results and download the zip. Every request's latency and status is kept;
+the report gives p50/p95/p99 and error rate per step, and throughput, per level.
+
+    python loadtest.py --photos ~/event --levels 1,5,20
+    python loadtest.py --photos ~/event --threads 16     # more threads than the config
+    python loadtest.py --photos ~/event --server http://127.0.0.1:5000   # started with BEHIND_HTTPS=0
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DRIVE_FOLDER = 'loadtest'
+DRIVE_FOLDER_MIME = 'application/vnd.google-apps.folder'
+REQUEST_TIMEOUT = 300
+JOB_POLL = 0.5
+MATCH_RETRIES = 20
+VALID_EXT = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+class LocalDrive:
+    """Enough of the Drive v3 client for the import: one folder, served from a local
+    directory, with a fixed delay per download standing in for the network."""
+
+    class _Call:
+        def __init__(self, value):
+            self.value = value
+
+        def execute(self):
+            return self.value
+
+    def __init__(self, folder, latency):
+        self.folder = folder
+        self.latency = latency
+        names = sorted(n for n in os.listdir(folder) if os.path.splitext(n)[1].lower() in VALID_EXT)
+        # Drive ids may not contain dots
+        self.names = {f'f{i}': n for i, n in enumerate(names)}
+        self.md5 = {}
+
+    def files(self):
+        return self
+
+    def meta(self, file_id):
+        path = os.path.join(self.folder, self.names[file_id])
+        if file_id not in self.md5:
+            with open(path, 'rb') as f:
+                self.md5[file_id] = hashlib.md5(f.read()).hexdigest()
+        st = os.stat(path)
+        return {'id': file_id, 'name': self.names[file_id], 'mimeType': 'image/jpeg', 'size': str(st.st_size),
+                'md5Checksum': self.md5[file_id], 'modifiedTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(st.st_mtime))}
+
+    def list(self, q, **kwargs):
+        files = [self.meta(fid) for fid in self.names] if f"'{DRIVE_FOLDER}'" in q else []
+        return self._Call({'files': files})
+
+    def get(self, fileId, **kwargs):
+        if fileId == DRIVE_FOLDER:
+            return self._Call({'id': DRIVE_FOLDER, 'name': 'Load test', 'mimeType': DRIVE_FOLDER_MIME})
+        return self._Call(self.meta(fileId))
+
+    def download(self, service, file_id, path):
+        """Stands in for app.download_drive_file."""
+        time.sleep(self.latency)
+        md5, sha256, size = hashlib.md5(), hashlib.sha256(), 0
+        with open(os.path.join(self.folder, self.names[file_id]), 'rb') as src, open(path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                md5.update(chunk)
+                sha256.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+        return md5.hexdigest(), sha256.hexdigest(), size
+
+
+def stubbed_app():
+    """WSGI factory for gunicorn: the app, with Drive served from $LOADTEST_DRIVE."""
+    import app
+    drive = LocalDrive(os.environ['LOADTEST_DRIVE'], float(os.environ.get('LOADTEST_DRIVE_LATENCY', '0.05')))
+    app.user_drive_service = lambda: drive
+    app.download_drive_file = drive.download
+    return app.app
+
+
+def start_server(workdir, port, drive_photos, drive_latency, threads, log):
+    """gunicorn on gunicorn_config.py in workdir; returns once it answers /readyz."""
+    import requests
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(HERE, 'gunicorn_config.py'),
+           '--chdir', workdir, '--pythonpath', HERE, '--bind', f'127.0.0.1:{port}']
+    if threads:
+        cmd += ['--threads', str(threads)]
+    cmd.append('loadtest:stubbed_app()')
+    # plain http on localhost, so the session cookie must not be marked Secure
+    env = dict(os.environ, BEHIND_HTTPS='0', LOADTEST_DRIVE=os.path.abspath(drive_photos),
+               LOADTEST_DRIVE_LATENCY=str(drive_latency))
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+    # /readyz answers 200 once the one worker has loaded its models; several in a row means it stays up
+    ready, deadline = 0, time.time() + 600
+    while ready < 5:
+        if proc.poll() is not None or time.time() > deadline:
+            proc.kill()
+            sys.exit(f'gunicorn did not come up; see {log.name}')
+        try:
+            ok = requests.get(f'http://127.0.0.1:{port}/readyz', timeout=5).status_code == 200
+        except requests.RequestException:
+            ok = False
+        ready = ready + 1 if ok else 0
+        time.sleep(0.2 if ok else 1)
+    return proc
+
+
+class Visitor:
+    """One scripted visit on its own cookie jar, so each is a separate session."""
+
+    def __init__(self, base, photos, drive, record):
+        import requests
+        self.requests = requests
+        self.http = requests.Session()
+        self.base = base
+        self.photos = photos
+        self.drive = drive
+        self.record = record
+
+    def call(self, step, method, path, stream=False, **kwargs):
+        """One request, timed to its last byte and recorded. The response, or None."""
+        started = time.perf_counter()
+        response, error = None, None
+        try:
+            response = self.http.request(method, self.base + path, timeout=REQUEST_TIMEOUT, stream=stream, **kwargs)
+            if stream:
+                for _ in response.iter_content(1024 * 1024):
+                    pass
+            status = response.status_code
+            if status >= 400:
+                try:
+                    error = response.json().get('error')
+                except ValueError:
+                    error = response.reason
+        except self.requests.RequestException as e:
+            status, error = 0, type(e).__name__
+        self.record(step, time.perf_counter() - started, status, error)
+        return response if response is not None and status < 400 else None
+
+    def wait_job(self, step, response):
+        """Poll a job to the end, recording the whole wait as step. Its last state, or None."""
+        if response is None:
+            return None
+        started = time.perf_counter()
+        while True:
+            r = self.call('job poll', 'GET', f"/api/jobs/{response.json()['job_id']}")
+            if r is None:
+                # the poll itself failed, and its own error is under 'job poll'. A 404 there
+                # means the job is gone: jobs live in the worker's memory, so the worker was
+                # restarted, most often by gunicorn's timeout, or it died
+                self.record(step, time.perf_counter() - started, 0, 'lost track of the job')
+                return None
+            job = r.json()
+            if job['status'] != 'running' and not job.get('downloading'):
+                status = 200 if job['status'] == 'done' else 500
+                self.record(step, time.perf_counter() - started, status, job.get('error'))
+                return job
+            time.sleep(JOB_POLL)
+
+    def upload(self, photo):
+        with open(photo, 'rb') as f:
+            data = f.read()
+        r = self.call('upload start', 'POST', '/api/uploads', json={'name': os.path.basename(photo), 'size': len(data)})
+        if r is None:
+            return None
+        started = r.json()
+        if started.get('duplicate'):
+            return started['path']
+        step = started['chunk_size']
+        for offset in range(0, len(data), step):
+            if self.call('upload chunk', 'PUT', f"/api/uploads/{started['upload_id']}?offset={offset}",
+                         data=data[offset:offset + step]) is None:
+                return None
+        r = self.call('upload finalize', 'POST', f"/api/uploads/{started['upload_id']}/finalize")
+        return r.json()['path'] if r is not None else None
+
+    def visit(self):
+        self.call('page', 'GET', '/')
+        paths = [p for p in map(self.upload, self.photos) if p]
+        if self.drive:
+            job = self.wait_job('drive import (job)', self.call(
+                'drive import', 'POST', '/api/drive/import', json={'folder_ids': [DRIVE_FOLDER]}))
+            paths += job['images'] if job else []
+        if not paths:
+            return
+        for page in (1, 2):
+            self.call('gallery', 'POST', '/api/gallery', json={'images': paths, 'page': page})
+
+        for path in paths:
+            r = self.call('image load', 'POST', '/api/image/load', json={'path': path, 'mode': 'geometry'})
+            if r is not None and r.json().get('faces'):
+                break
+        else:
+            return
+        if self.call('face set', 'POST', '/api/face/set', json={'path': path, 'face_index': 0}) is None:
+            return
+
+        for _ in range(MATCH_RETRIES):
+            r = self.http.post(self.base + '/api/match/run', json={'images': paths}, timeout=REQUEST_TIMEOUT)
+            if r.status_code != 429:
+                break
+            self.record('match run', r.elapsed.total_seconds(), 429, 'busy')
+            time.sleep(int(r.headers.get('Retry-After', 1)))
+        self.record('match run', r.elapsed.total_seconds(), r.status_code,
+                    r.json().get('error') if r.status_code >= 400 else None)
+        if self.wait_job('match (job)', r if r.status_code == 202 else None) is None:
+            return
+        self.call('results', 'GET', '/api/results')
+        self.call('export zip', 'POST', '/api/export/zip', json={}, stream=True)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run_level(base, photos, concurrency, visits, per_session, drive, seed):
+    """concurrency visitors at once until visits visits are done; the level's report."""
+    samples, lock = [], threading.Lock()
+
+    def record(step, seconds, status, error):
+        with lock:
+            samples.append((step, seconds, status, error))
+
+    def one(i):
+        rng = random.Random(seed * 1000 + i)
+        try:
+            Visitor(base, rng.sample(photos, min(per_session, len(photos))), drive, record).visit()
+        except Exception as e:
+            record('visit aborted', 0.0, 0, f'{type(e).__name__}: {e}')
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(one, range(visits)))
+    wall = time.perf_counter() - started
+
+    steps, errors = {}, {}
+    for step, seconds, status, error in samples:
+        steps.setdefault(step, []).append((seconds, status))
+        if status >= 400 or status == 0:
+            key = f'{step}: {status} {error}'
+            errors[key] = errors.get(key, 0) + 1
+    requests_made = [s for s in samples if not s[0].endswith('(job)')]
+    failed = [s for s in requests_made if s[2] == 0 or (s[2] >= 400 and s[2] != 429)]
+    return {
+        'concurrency': concurrency,
+        'visits': visits,
+        'seconds': round(wall, 2),
+        'requests': len(requests_made),
+        'requests_per_sec': round(len(requests_made) / wall, 2),
+        'visits_per_min': round(visits / wall * 60, 2),
+        'error_rate': round(len(failed) / max(1, len(requests_made)), 4),
+        'throttled': sum(1 for s in requests_made if s[2] == 429),
+        'steps': {step: {
+            'count': len(v),
+            'p50': round(percentile([s for s, _ in v], 50), 4),
+            'p95': round(percentile([s for s, _ in v], 95), 4),
+            'p99': round(percentile([s for s, _ in v], 99), 4),
+            'errors': sum(1 for _, st in v if st == 0 or (st >= 400 and st != 429)),
+        } for step, v in steps.items()},
+        'error_kinds': dict(sorted(errors.items(), key=lambda e: -e[1])),
+    }
+
+
+def report(level):
+    print(f"\n{level['concurrency']} at once: {level['visits']} visits in {level['seconds']}s, "
+          f"{level['requests_per_sec']} req/s, {level['visits_per_min']} visits/min, "
+          f"{level['error_rate']:.1%} errors, {level['throttled']} throttled (429)")
+    print(f"  {'':22}{'n':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'errors':>8}")
+    for step, s in level['steps'].items():
+        print(f"  {step:22}{s['count']:6}{s['p50']:9.3f}{s['p95']:9.3f}{s['p99']:9.3f}{s['errors']:8}")
+    for kind, n in list(level['error_kinds'].items())[:8]:
+        print(f'  ! {n} x {kind}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent-visitor load test.')
+    parser.add_argument('--photos', required=True, help='folder of photos for visitors to upload')
+    parser.add_argument('--drive-photos', help='folder the stub Drive serves (default: --photos)')
+    parser.add_argument('--drive-latency', type=float, default=0.05, help='seconds per stub Drive download')
+    parser.add_argument('--no-drive', action='store_true', help='skip the Drive import step')
+    parser.add_argument('--levels', default='1,5,20', help='visitors at once, comma separated')
+    parser.add_argument('--visits', type=int, default=2, help='visits per visitor slot at each level')
+    parser.add_argument('--per-session', type=int, default=10, help='photos each visitor uploads')
+    parser.add_argument('--threads', type=int, help='override gunicorn_config.py')
+    parser.add_argument('--port', type=int, default=8599)
+    parser.add_argument('--server', help='test a server already running at this URL instead')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch folder and server log')
+    parser.add_argument('--out', help='write the report here as JSON')
+    args = parser.parse_args()
+
+    photos = sorted(os.path.join(args.photos, n) for n in os.listdir(args.photos)
+                    if os.path.splitext(n)[1].lower() in VALID_EXT)
+    if not photos:
+        sys.exit(f'No photos in {args.photos}')
+
+    proc, workdir = None, None
+    base = args.server.rstrip('/') if args.server else f'http://127.0.0.1:{args.port}'
+    if not args.server:
+        workdir = tempfile.mkdtemp(prefix='tiam-loadtest-')
+        log = open(os.path.join(workdir, 'server.log'), 'w')
+        print(f'starting gunicorn in {workdir} ...', flush=True)
+        proc = start_server(workdir, args.port, args.drive_photos or args.photos, args.drive_latency,
+                            args.threads, log)
+    try:
+        levels = []
+        for seed, concurrency in enumerate(int(c) for c in args.levels.split(',')):
+            level = run_level(base, photos, concurrency, concurrency * args.visits, args.per_session,
+                              not args.no_drive, seed)
+            report(level)
+            levels.append(level)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            if args.keep:
+                print(f'\nserver log and files kept in {workdir}')
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        settings = {'threads': args.threads, 'server': args.server,
+                    'per_session': args.per_session, 'drive': not args.no_drive}
+        with open(args.out, 'w') as f:
+            json.dump({'settings': settings, 'levels': levels}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
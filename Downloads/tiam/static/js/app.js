@@ -7,12 +7,15 @@ let cropData = { x1: 0, y1: 0, x2: 0, y2: 0 };
 let isCropping = false;
 let cropStart = { x: 0, y: 0 };
 let cropEnd = { x: 0, y: 0 };
-let matchingResults = [];
+let currentFaces = [];
+let selectedFaceIndex = null;
+let galleryPageSize = 20;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', function() {
     setupEventListeners();
     handleDriveReturn();
+    loadPersons();
 
     // Auto-load if configured
     if (typeof autoLoadEnabled !== 'undefined' && autoLoadEnabled) {
@@ -132,6 +135,13 @@ function selectSource(source) {
     }
 }
 
+// Photos go up in chunks, a few files at a time. A dropped connection retries the
+// chunk it was on, and a file this browser started before carries on from where it
+// stopped rather than starting again.
+const UPLOAD_PARALLEL = 3;
+// Hashing lets the server skip a photo it already has, but needs the whole file in memory
+const UPLOAD_HASH_LIMIT = 32 * 1024 * 1024;
+
 async function uploadPhotos() {
     const input = document.getElementById('photo-files');
     const status = document.getElementById('upload-status');
@@ -142,42 +152,126 @@ async function uploadPhotos() {
         return;
     }
 
-    const form = new FormData();
-    for (const f of files) {
-        form.append('files', f);
+    const queue = Array.from(files);
+    const paths = [];
+    let finished = 0, skipped = 0, duplicates = 0, failed = 0;
+    status.textContent = `Uploading ${files.length} photo(s)...`;
+
+    async function handle(file) {
+        try {
+            const result = await uploadOne(file);
+            if (result.skipped) {
+                skipped++;
+            } else {
+                paths.push(result.path);
+                if (result.duplicate) duplicates++;
+            }
+        } catch (error) {
+            failed++;
+            clientLog('upload', file.name + ': ' + error.message);
+        }
+        finished++;
+        status.textContent = `Uploading... ${finished} of ${files.length} done.`;
     }
 
-    status.textContent = `Uploading ${files.length} photo(s)...`;
+    async function worker() {
+        while (queue.length) {
+            await handle(queue.shift());
+        }
+    }
 
-    try {
-        const response = await fetch('/api/images/upload', {
-            method: 'POST',
-            body: form
-        });
+    // one file on its own first, so the visitor's workspace exists before several
+    // requests race to create it
+    await handle(queue.shift());
+    await Promise.all(Array.from({ length: UPLOAD_PARALLEL }, worker));
 
-        const data = await response.json();
+    const unique = Array.from(new Set(paths)).sort();
+    if (unique.length === 0) {
+        status.textContent = failed
+            ? `Upload failed for ${failed} photo(s). Press Upload again to pick up where it stopped.`
+            : 'None of those files were usable images.';
+        return;
+    }
+    // skipped covers non-images the picker let through, e.g. HEIC or video
+    status.textContent = `Uploaded ${unique.length} photo(s).`
+        + (duplicates ? ` ${duplicates} were already here.` : '')
+        + (skipped ? ` Skipped ${skipped} unsupported file(s).` : '')
+        + (failed ? ` ${failed} failed - press Upload again to resume them.` : '');
+    allImages = unique;
+    document.getElementById('total-images-count').textContent = allImages.length;
+    showStep(2);
+    loadGallery(1);
+}
+
+async function uploadOne(file) {
+    const key = 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+    let uploadId = localStorage.getItem(key);
+    let offset = 0;
+    let chunkSize = 0;
 
+    if (uploadId) {
+        const response = await fetch('/api/uploads/' + encodeURIComponent(uploadId));
         if (response.ok) {
-            if (data.count === 0) {
-                status.textContent = 'None of those files were usable images.';
-                return;
-            }
-            // skipped covers non-images the picker let through, e.g. HEIC or video
-            status.textContent = data.skipped
-                ? `Uploaded ${data.count}, skipped ${data.skipped} unsupported file(s).`
-                : `Uploaded ${data.count} photo(s).`;
-            allImages = data.images;
-            document.getElementById('total-images-count').textContent = allImages.length;
-            showStep(2);
-            loadGallery(1);
+            const progress = await response.json();
+            offset = progress.offset;
+            chunkSize = progress.chunk_size;
         } else {
-            status.textContent = '';
-            alert('Error: ' + data.error);
+            localStorage.removeItem(key);
+            uploadId = null;
         }
-    } catch (error) {
-        status.textContent = '';
-        alert('Error uploading photos: ' + error.message);
     }
+
+    if (!uploadId) {
+        const response = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ name: file.name, size: file.size, sha256: await fileSha256(file) })
+        });
+        const started = await response.json();
+        if (!response.ok) {
+            if (started.skipped) return { skipped: true };
+            throw new Error(started.error || ('HTTP ' + response.status));
+        }
+        if (started.duplicate) return { path: started.path, duplicate: true };
+        uploadId = started.upload_id;
+        chunkSize = started.chunk_size;
+        localStorage.setItem(key, uploadId);
+    }
+
+    while (offset < file.size) {
+        offset = await sendChunk(uploadId, file, offset, chunkSize);
+    }
+
+    const response = await fetch('/api/uploads/' + encodeURIComponent(uploadId) + '/finalize', { method: 'POST' });
+    const done = await response.json();
+    if (!response.ok) throw new Error(done.error || ('HTTP ' + response.status));
+    localStorage.removeItem(key);
+    return { path: done.path, duplicate: done.duplicate };
+}
+
+async function sendChunk(uploadId, file, offset, chunkSize) {
+    for (let attempt = 0; ; attempt++) {
+        try {
+            const response = await fetch('/api/uploads/' + encodeURIComponent(uploadId) + '?offset=' + offset, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: file.slice(offset, offset + chunkSize)
+            });
+            const result = await response.json();
+            // 409 means the server holds a different amount than we thought; carry on from its offset
+            if (response.ok || response.status === 409) return result.offset;
+            throw new Error(result.error || ('HTTP ' + response.status));
+        } catch (error) {
+            if (attempt >= 4) throw error;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+    }
+}
+
+async function fileSha256(file) {
+    if (!(window.crypto && crypto.subtle) || file.size > UPLOAD_HASH_LIMIT) return '';
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
 }
 
 async function authenticateDrive() {
@@ -358,27 +452,64 @@ async function pickerCallback(data) {
             alert('Error: ' + result.error);
             return;
         }
+        await followDriveImport(result.job_id, status);
+    } catch (error) {
+        status.textContent = '';
+        clientLog('picker', 'import threw: ' + error.message);
+        alert('Error importing: ' + error.message);
+    }
+}
+
+// The import runs on the server in the background. Poll it, and open the gallery
+// as soon as the first photo lands rather than after the last one.
+async function followDriveImport(jobId, status) {
+    let opened = false;
+    while (true) {
+        const response = await fetch('/api/jobs/' + encodeURIComponent(jobId));
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.error || ('HTTP ' + response.status));
+        }
+
+        const grew = job.images.length > allImages.length;
+        if (grew || !opened) {
+            allImages = job.images;
+            document.getElementById('total-images-count').textContent = allImages.length;
+        }
+        if (!opened && allImages.length > 0) {
+            opened = true;
+            showStep(2);
+            loadGallery(1);
+        } else if (opened && grew) {
+            refreshGalleryCount();
+        }
 
-        if (result.count === 0) {
-            status.textContent = result.unreadable_folders
-                ? 'Google did not grant access to that folder. Open the folder in the picker and select the photos themselves.'
-                : 'No usable photos were found in that selection.';
+        if (job.status === 'failed') {
+            clientLog('picker', 'import job failed: ' + job.error);
+            status.textContent = '';
+            alert('Error importing: ' + job.error);
             return;
         }
 
-        status.textContent = 'Imported ' + result.count + ' photo(s).'
-            + (result.unreadable_folders
-                ? ' ' + result.unreadable_folders + ' folder(s) could not be opened — select the photos inside them instead.'
-                : '');
+        if (job.status === 'done') {
+            if (job.count === 0) {
+                status.textContent = job.unreadable_folders
+                    ? 'Google did not grant access to that folder. Open the folder in the picker and select the photos themselves.'
+                    : 'No usable photos were found in that selection.';
+                return;
+            }
+            status.textContent = 'Imported ' + job.count + ' photo(s).'
+                + (job.reused ? ' ' + job.reused + ' were already here and did not need downloading again.' : '')
+                + (job.unreadable_folders
+                    ? ' ' + job.unreadable_folders + ' folder(s) could not be opened — select the photos inside them instead.'
+                    : '');
+            return;
+        }
 
-        allImages = result.images;
-        document.getElementById('total-images-count').textContent = allImages.length;
-        showStep(2);
-        loadGallery(1);
-    } catch (error) {
-        status.textContent = '';
-        clientLog('picker', 'import threw: ' + error.message);
-        alert('Error importing: ' + error.message);
+        status.textContent = job.downloading
+            ? 'Copied ' + job.count + ' photo(s) so far — you can start browsing while the rest arrive.'
+            : 'Copied ' + job.count + ' photo(s). Preparing them for matching (' + job.prepared + ' done)…';
+        await new Promise(resolve => setTimeout(resolve, 1000));
     }
 }
 
@@ -395,6 +526,7 @@ async function loadGallery(page) {
         if (response.ok) {
             currentPage = data.page;
             totalPages = data.total_pages;
+            galleryPageSize = data.page_size || galleryPageSize;
             
             document.getElementById('page-info').textContent = 
                 `Page ${currentPage} / ${totalPages}`;
@@ -420,6 +552,18 @@ async function loadGallery(page) {
     }
 }
 
+// Photos still arriving from an import: keep the page count honest, and fill the
+// page being looked at if it is not full yet.
+function refreshGalleryCount() {
+    totalPages = Math.max(1, Math.ceil(allImages.length / galleryPageSize));
+    document.getElementById('page-info').textContent = `Page ${currentPage} / ${totalPages}`;
+    const shown = document.getElementById('image-gallery').children.length;
+    const step2 = document.getElementById('step2');
+    if (shown < galleryPageSize && step2 && step2.style.display !== 'none') {
+        loadGallery(currentPage);
+    }
+}
+
 function prevPage() {
     if (currentPage > 1) {
         loadGallery(currentPage - 1);
@@ -439,18 +583,34 @@ async function openCropUI(imagePath) {
         const response = await fetch('/api/image/load', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ path: imagePath })
+            // boxes only; the photo itself comes from the cacheable /api/image
+            body: JSON.stringify({ path: imagePath, mode: 'geometry' })
         });
         
         const data = await response.json();
         
         if (response.ok) {
+            currentFaces = data.faces;
+            // Start on the first detected face, else the centre
+            if (currentFaces.length) {
+                selectedFaceIndex = 0;
+                const [x1, y1, x2, y2] = currentFaces[0].bbox;
+                cropData = { x1, y1, x2, y2 };
+            } else {
+                selectedFaceIndex = null;
+                cropData = {
+                    x1: Math.floor(data.width / 4),
+                    y1: Math.floor(data.height / 4),
+                    x2: Math.floor(data.width * 3 / 4),
+                    y2: Math.floor(data.height * 3 / 4)
+                };
+            }
             const img = document.getElementById('crop-image');
-            img.src = data.image;
             img.onload = function() {
-                setupCropCanvas(data.width, data.height);
                 showStep(3);
+                setupCropCanvas();
             };
+            img.src = data.image;
         } else {
             alert('Error loading image: ' + data.error);
         }
@@ -459,12 +619,11 @@ async function openCropUI(imagePath) {
     }
 }
 
-function setupCropCanvas(width, height) {
+function setupCropCanvas() {
     const canvas = document.getElementById('crop-canvas');
     const img = document.getElementById('crop-image');
     
-    // Wait for image to load
-    img.onload = function() {
+    const init = function() {
         canvas.width = img.offsetWidth;
         canvas.height = img.offsetHeight;
         
@@ -472,24 +631,18 @@ function setupCropCanvas(width, height) {
         const scaleX = img.naturalWidth / img.offsetWidth;
         const scaleY = img.naturalHeight / img.offsetHeight;
         
-        // Initialize crop area to center
-        cropData = {
-            x1: Math.floor(width / 4),
-            y1: Math.floor(height / 4),
-            x2: Math.floor(width * 3 / 4),
-            y2: Math.floor(height * 3 / 4)
-        };
         
-        canvas.addEventListener('mousedown', (e) => {
+        canvas.onmousedown = (e) => {
             isCropping = true;
+            selectedFaceIndex = null;
             const rect = canvas.getBoundingClientRect();
             cropStart = {
                 x: (e.clientX - rect.left) * scaleX,
                 y: (e.clientY - rect.top) * scaleY
             };
-        });
+        };
         
-        canvas.addEventListener('mousemove', (e) => {
+        canvas.onmousemove = (e) => {
             if (isCropping) {
                 const rect = canvas.getBoundingClientRect();
                 cropEnd = {
@@ -498,9 +651,9 @@ function setupCropCanvas(width, height) {
                 };
                 drawCropBox(ctx, cropStart, cropEnd, scaleX, scaleY, img.offsetWidth, img.offsetHeight);
             }
-        });
+        };
         
-        canvas.addEventListener('mouseup', () => {
+        canvas.onmouseup = () => {
             if (isCropping) {
                 isCropping = false;
                 cropData = {
@@ -510,13 +663,47 @@ function setupCropCanvas(width, height) {
                     y2: Math.floor(Math.max(cropStart.y, cropEnd.y))
                 };
                 updatePreview();
+                renderFaceChoices();
             }
-        });
+        };
         
         drawCropBox(ctx, { x: cropData.x1, y: cropData.y1 }, 
                     { x: cropData.x2, y: cropData.y2 }, scaleX, scaleY, img.offsetWidth, img.offsetHeight);
         updatePreview();
+        renderFaceChoices();
     };
+    
+    if (img.complete && img.naturalWidth) {
+        init();
+    } else {
+        img.onload = init;
+    }
+}
+
+function renderFaceChoices() {
+    const list = document.getElementById('face-choices');
+    list.innerHTML = '';
+    currentFaces.forEach(face => {
+        const choice = document.createElement('img');
+        choice.src = face.crop;
+        choice.alt = `Face ${face.index + 1}`;
+        choice.title = `Face ${face.index + 1}`;
+        choice.className = 'face-choice' + (face.index === selectedFaceIndex ? ' selected' : '');
+        choice.onclick = () => selectFace(face.index);
+        list.appendChild(choice);
+    });
+}
+
+function selectFace(index) {
+    const [x1, y1, x2, y2] = currentFaces[index].bbox;
+    selectedFaceIndex = index;
+    cropData = { x1, y1, x2, y2 };
+    setupCropCanvas();
+}
+
+// The face the server should use: its index when one was picked, else the drawn box
+function chosenFace() {
+    return selectedFaceIndex !== null ? { face_index: selectedFaceIndex } : { ...cropData };
 }
 
 function drawCropBox(ctx, start, end, scaleX, scaleY, canvasWidth, canvasHeight) {
@@ -538,6 +725,16 @@ function drawCropBox(ctx, start, end, scaleX, scaleY, canvasWidth, canvasHeight)
     ctx.strokeStyle = '#667eea';
     ctx.lineWidth = 2;
     ctx.strokeRect(x1, y1, x2 - x1, y2 - y1);
+    
+    // Outline every detected face, drawn here rather than baked into the image
+    ctx.strokeStyle = '#22c55e';
+    ctx.fillStyle = '#22c55e';
+    ctx.font = '13px sans-serif';
+    currentFaces.forEach(face => {
+        const [fx1, fy1, fx2, fy2] = face.bbox;
+        ctx.strokeRect(fx1 / scaleX, fy1 / scaleY, (fx2 - fx1) / scaleX, (fy2 - fy1) / scaleY);
+        ctx.fillText(`Face ${face.index + 1}`, fx1 / scaleX, Math.max(12, fy1 / scaleY - 4));
+    });
 }
 
 function updatePreview() {
@@ -577,13 +774,7 @@ async function setReferenceFace() {
         const response = await fetch('/api/face/set', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                path: currentImagePath,
-                x1: cropData.x1,
-                x2: cropData.x2,
-                y1: cropData.y1,
-                y2: cropData.y2
-            })
+            body: JSON.stringify({ path: currentImagePath, ...chosenFace() })
         });
         
         const data = await response.json();
@@ -599,6 +790,127 @@ async function setReferenceFace() {
     }
 }
 
+// Enrolment: crops picked in step 3 gather here until they are saved as a person. The
+// ids of saved people are kept in this browser; the server will not list anyone's.
+const PERSONS_KEY = 'persons';
+let enrolFaces = [];
+
+function savedPersonIds() {
+    try {
+        return JSON.parse(localStorage.getItem(PERSONS_KEY)) || [];
+    } catch (e) {
+        return [];
+    }
+}
+
+function addFaceToPerson() {
+    if (!currentImagePath) {
+        alert('No image selected');
+        return;
+    }
+    enrolFaces.push({ path: currentImagePath, ...chosenFace() });
+    document.getElementById('enrol-count').textContent = enrolFaces.length;
+}
+
+async function savePerson() {
+    const name = document.getElementById('person-name').value.trim();
+    if (!name) {
+        alert('Please enter a name');
+        return;
+    }
+    if (!enrolFaces.length) {
+        alert('Add at least one face first');
+        return;
+    }
+    
+    try {
+        const response = await fetch('/api/persons', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ name: name, faces: enrolFaces })
+        });
+        const data = await response.json();
+        
+        if (response.ok) {
+            localStorage.setItem(PERSONS_KEY, JSON.stringify([...savedPersonIds(), data.person_id]));
+            enrolFaces = [];
+            document.getElementById('enrol-count').textContent = 0;
+            await loadPersons();
+            await usePerson(data.person_id);
+        } else {
+            alert('Error: ' + data.error);
+        }
+    } catch (error) {
+        alert('Error: ' + error.message);
+    }
+}
+
+async function loadPersons() {
+    const ids = savedPersonIds();
+    const list = document.getElementById('person-list');
+    list.innerHTML = '';
+    document.getElementById('saved-persons').style.display = 'none';
+    if (!ids.length) return;
+    
+    try {
+        const response = await fetch('/api/persons?ids=' + ids.map(encodeURIComponent).join(','));
+        if (!response.ok) return;
+        const data = await response.json();
+        // forget people deleted elsewhere
+        localStorage.setItem(PERSONS_KEY, JSON.stringify(data.persons.map(p => p.person_id)));
+        
+        data.persons.forEach(person => {
+            const use = document.createElement('button');
+            use.className = 'btn btn-secondary';
+            use.textContent = `👤 ${person.name} (${person.faces})`;
+            use.onclick = () => usePerson(person.person_id);
+            const remove = document.createElement('button');
+            remove.className = 'btn btn-secondary';
+            remove.textContent = '✕';
+            remove.title = 'Delete ' + person.name;
+            remove.onclick = () => deletePerson(person.person_id, person.name);
+            list.appendChild(use);
+            list.appendChild(remove);
+        });
+        document.getElementById('saved-persons').style.display = data.persons.length ? 'block' : 'none';
+    } catch (error) {
+        console.error('Could not load saved people', error);
+    }
+}
+
+async function usePerson(personId) {
+    try {
+        const response = await fetch('/api/persons/' + encodeURIComponent(personId) + '/use', { method: 'POST' });
+        const data = await response.json();
+        
+        if (response.ok) {
+            alert('✅ ' + data.message);
+            showStep(4);
+        } else {
+            alert('Error: ' + data.error);
+        }
+    } catch (error) {
+        alert('Error: ' + error.message);
+    }
+}
+
+async function deletePerson(personId, name) {
+    if (!confirm(`Delete ${name}? Their saved faces cannot be recovered.`)) return;
+    
+    try {
+        const response = await fetch('/api/persons/' + encodeURIComponent(personId), { method: 'DELETE' });
+        if (!response.ok && response.status !== 404) {
+            const data = await response.json();
+            alert('Error: ' + data.error);
+            return;
+        }
+        localStorage.setItem(PERSONS_KEY, JSON.stringify(savedPersonIds().filter(id => id !== personId)));
+        await loadPersons();
+    } catch (error) {
+        alert('Error: ' + error.message);
+    }
+}
+
 async function runMatching() {
     const progressDiv = document.getElementById('matching-progress');
     const progressFill = document.getElementById('progress-fill');
@@ -617,13 +929,13 @@ async function runMatching() {
         
         const data = await response.json();
         
-        if (response.ok) {
-            progressFill.style.width = '100%';
-            progressText.textContent = 'Matching complete!';
-            
-            matchingResults = data.results;
-            displayResults(data);
-            showStep(5);
+        if (response.status === 429) {
+            // busy, not broken: the server says when there will be room
+            const wait = parseInt(response.headers.get('Retry-After') || data.retry_after || '5', 10);
+            progressText.textContent = `${data.error} Trying again in ${wait}s…`;
+            setTimeout(runMatching, wait * 1000);
+        } else if (response.ok) {
+            await followMatching(data.job_id, progressFill, progressText);
         } else {
             alert('Error: ' + data.error);
             progressDiv.style.display = 'none';
@@ -634,29 +946,73 @@ async function runMatching() {
     }
 }
 
+async function followMatching(jobId, progressFill, progressText) {
+    while (true) {
+        const response = await fetch('/api/jobs/' + encodeURIComponent(jobId));
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.error || ('HTTP ' + response.status));
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error);
+        }
+        
+        progressFill.style.width = (job.total ? Math.round(job.done / job.total * 100) : 100) + '%';
+        
+        if (job.status === 'done') {
+            progressText.textContent = (job.reused
+                ? `Matching complete! Scored ${job.scored} new photos, reused ${job.reused}.`
+                : 'Matching complete!')
+                + (job.prefiltered
+                    ? ` ${job.prefiltered} (${(job.prefilter_rate * 100).toFixed(1)}%) had no one in them and were skipped.`
+                    : '');
+            displayResults(await fetchResults(null));
+            showStep(5);
+            return;
+        }
+        
+        progressText.textContent = job.queue_position > 0
+            ? `Waiting behind ${job.queue_position} other photo(s) in the queue… ${job.done} of ${job.total} done.`
+            : `Matching… ${job.done} of ${job.total} photos.`;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+// Results arrive a page at a time, best first. The server sorts and filters, so the
+// browser only ever holds what is on screen.
+let resultsCursor = null;
+let resultsThreshold = 0;
+
 function displayResults(data) {
     document.getElementById('matched-count').textContent = data.matched;
     document.getElementById('total-count').textContent = data.total;
     document.getElementById('match-rate').textContent = 
         ((data.matched / data.total) * 100).toFixed(1) + '%';
     
+    // colour against the threshold the server actually used, or the badges
+    // contradict the Match/No Match column sitting next to them
+    resultsThreshold = data.threshold;
+    document.getElementById('results-body').innerHTML = '';
+    appendResultRows(data.results);
+    setResultsCursor(data.next_cursor);
+}
+
+function appendResultRows(results) {
     const tbody = document.getElementById('results-body');
-    tbody.innerHTML = '';
-    
-    data.results.forEach(result => {
+    results.forEach(result => {
         const tr = document.createElement('tr');
         
         const similarity = result.max_similarity;
-        // colour against the threshold the server actually used, or the badges
-        // contradict the Match/No Match column sitting next to them
-        const thr = data.threshold;
+        const thr = resultsThreshold;
         let simClass = 'similarity-low';
         if (similarity >= thr) simClass = 'similarity-high';
         else if (similarity >= thr - 0.1) simClass = 'similarity-medium';
         
-        const imageUrl = '/api/image?path=' + encodeURIComponent(result.image_path.replace(/\\/g, '/'));
+        // the face that scored, from the crop cache; the whole photo only when no face was found
+        const imageUrl = result.crop
+            || '/api/image?size=200&path=' + encodeURIComponent(result.image_path.replace(/\\/g, '/'));
         tr.innerHTML = `
-            <td><img src="${imageUrl}" style="max-width: 100px; height: auto; border-radius: 4px;" onerror="this.style.display='none'"></td>
+            <td><img src="${imageUrl}" loading="lazy" style="max-width: 100px; height: auto; border-radius: 4px;" onerror="this.style.display='none'"></td>
             <td style="max-width: 300px; word-break: break-all;">${result.image_path}</td>
             <td><span class="similarity-badge ${simClass}">${(similarity * 100).toFixed(1)}%</span></td>
             <td>${result.faces}</td>
@@ -669,6 +1025,42 @@ function displayResults(data) {
     });
 }
 
+function setResultsCursor(cursor) {
+    resultsCursor = cursor || null;
+    document.getElementById('results-more').style.display = resultsCursor ? 'inline-block' : 'none';
+}
+
+async function fetchResults(cursor) {
+    const params = new URLSearchParams();
+    if (document.getElementById('matches-only').checked) params.set('matches_only', '1');
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch('/api/results?' + params.toString());
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || ('HTTP ' + response.status));
+    return data;
+}
+
+async function loadMoreResults() {
+    try {
+        const data = await fetchResults(resultsCursor);
+        appendResultRows(data.results);
+        setResultsCursor(data.next_cursor);
+    } catch (error) {
+        alert('Error loading results: ' + error.message);
+    }
+}
+
+async function reloadResults() {
+    try {
+        const data = await fetchResults(null);
+        document.getElementById('results-body').innerHTML = '';
+        appendResultRows(data.results);
+        setResultsCursor(data.next_cursor);
+    } catch (error) {
+        alert('Error loading results: ' + error.message);
+    }
+}
+
 async function exportMatches() {
     const folderName = document.getElementById('export-folder').value.trim();
     
@@ -685,10 +1077,7 @@ async function exportMatches() {
         const response = await fetch('/api/export', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                folder_name: folderName,
-                results: matchingResults
-            })
+            body: JSON.stringify({ folder_name: folderName })
         });
         
         const data = await response.json();
@@ -707,6 +1096,75 @@ async function exportMatches() {
     }
 }
 
+// Sending to Drive runs on the server in the background, several uploads at a time;
+// a few hundred photos outlast any request. Poll it the way an import is polled.
+async function exportToDrive() {
+    const folderName = document.getElementById('export-folder').value.trim();
+    
+    if (!folderName) {
+        alert('Please enter a folder name');
+        return;
+    }
+    
+    const statusDiv = document.getElementById('export-status');
+    statusDiv.textContent = 'Creating the folder in Google Drive...';
+    statusDiv.className = '';
+    
+    try {
+        const response = await fetch('/api/export/drive', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ folder_name: folderName, background: true })
+        });
+        
+        const data = await response.json();
+        
+        if (response.status === 401) {
+            statusDiv.textContent = 'Connect your Google Drive first (Step 1), then send the matches again.';
+            statusDiv.className = 'export-error';
+        } else if (response.ok) {
+            await followDriveExport(data.job_id, statusDiv);
+        } else {
+            statusDiv.textContent = 'Error: ' + data.error;
+            statusDiv.className = 'export-error';
+        }
+    } catch (error) {
+        statusDiv.textContent = 'Error: ' + error.message;
+        statusDiv.className = 'export-error';
+    }
+}
+
+async function followDriveExport(jobId, statusDiv) {
+    while (true) {
+        const response = await fetch('/api/jobs/' + encodeURIComponent(jobId));
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.error || ('HTTP ' + response.status));
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error);
+        }
+        
+        if (job.status === 'done') {
+            const failed = job.files.filter(f => f.status === 'failed');
+            statusDiv.textContent = `✅ Sent ${job.uploaded} images to ${job.folder_name} in Google Drive`
+                + (failed.length
+                    ? `. ${failed.length} could not be sent: `
+                        + failed.slice(0, 5).map(f => `${f.name} (${f.error})`).join(', ')
+                        + (failed.length > 5 ? '…' : '')
+                    : '');
+            statusDiv.className = failed.length ? 'export-error' : 'export-success';
+            return;
+        }
+        
+        const retrying = job.files.filter(f => f.status === 'uploading' && f.attempts > 1).length;
+        statusDiv.textContent = `Sending to Google Drive… ${job.uploaded + job.failed} of ${job.total} done`
+            + (job.failed ? `, ${job.failed} failed` : '')
+            + (retrying ? `, retrying ${retrying}` : '') + '.';
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 function showStep(stepNumber) {
     for (let i = 1; i <= 6; i++) {
         const step = document.getElementById(`step${i}`);